@@ -4,12 +4,22 @@ share.streamlit.io 対応
 """
 
 import streamlit as st
+import orjson
 import json
 import os
 import re
-import hashlib
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-import random
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
 import requests
 
 # ==================== ページ設定 ====================
@@ -21,7 +31,8 @@ st.set_page_config(
 )
 
 # ==================== カスタムCSS ====================
-st.markdown("""
+# スタイルは定数にまとめ、再実行ごとに同じ文字列を1回だけ送る
+_CUSTOM_CSS = """
 <style>
     /* ヘッダー・フッター非表示 */
     #MainMenu {visibility: hidden;}
@@ -50,138 +61,240 @@ st.markdown("""
     .status-warn { background-color: #fff3cd; border-left: 4px solid #ffc107; }
     .status-error { background-color: #f8d7da; border-left: 4px solid #dc3545; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(_CUSTOM_CSS, unsafe_allow_html=True)
 
 # ==================== データ管理 ====================
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TOPOLOGY_PATH = os.path.join(DATA_DIR, "topology.json")
+MOCK_DATA_PATH = os.path.join(DATA_DIR, "mock_data.json")
+COMMAND_CACHE_PATH = os.path.join(DATA_DIR, "command_cache.json")
+
+# .get() のデフォルト用の空マッピング（変更不可なので使い回しても安全）
+_EMPTY = MappingProxyType({})
+
+def _file_mtime(path: str):
+    """ファイルの更新時刻を返す（存在しなければNone）。存在確認と兼ねてstatは1回だけ"""
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _load_json(path: str, mtime: float):
+    """JSONファイルを読み込む（mtimeもキャッシュキーに含め、ファイル更新時は自動で読み直す）"""
+    return orjson.loads(Path(path).read_bytes())
 
-@st.cache_data
 def load_topology():
     """トポロジーデータを読み込む"""
-    topology_path = os.path.join(DATA_DIR, "topology.json")
-    if os.path.exists(topology_path):
-        with open(topology_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    mtime = _file_mtime(TOPOLOGY_PATH)
+    if mtime is None:
+        return {}
+    return _load_json(TOPOLOGY_PATH, mtime)
+
+@st.cache_resource(show_spinner=False)
+def _shared_json(path: str, mtime: float):
+    """読み取り専用で共有するJSON（st.cache_dataと違い、呼び出しごとにコピーを作らない）"""
+    return _load_json(path, mtime)
 
-@st.cache_data
 def load_mock_data():
-    """モックデータを読み込む"""
-    mock_path = os.path.join(DATA_DIR, "mock_data.json")
-    if os.path.exists(mock_path):
-        with open(mock_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"hosts": {}, "alerts": [], "metrics_history": {}, "maintenance": {}}
+    """モックデータを読み込む
+    
+    全セッションで同じdictを共有するため、呼び出し側で変更しないこと
+    """
+    mtime = _file_mtime(MOCK_DATA_PATH)
+    if mtime is None:
+        return {"hosts": {}, "alerts": [], "metrics_history": {}, "maintenance": {}}
+    return _shared_json(MOCK_DATA_PATH, mtime)
+
+def _get_hosts(data: dict) -> dict:
+    return data.get("hosts", {})
+
+def _get_alerts(data: dict) -> list:
+    return data.get("alerts", [])
 
 def get_hosts():
     """ホスト一覧を取得"""
-    data = load_mock_data()
-    return data.get("hosts", {})
+    return _get_hosts(load_mock_data())
 
 def get_alerts():
     """アラート一覧を取得"""
-    data = load_mock_data()
-    return data.get("alerts", [])
+    return _get_alerts(load_mock_data())
+
+@st.cache_data(show_spinner=False)
+def _alert_index(mtime: float) -> tuple:
+    """アラートをホスト単位に集約する（ホスト→状態, 重大アラートマップ, 警告アラートマップ）"""
+    status_by_host = {}
+    alert_map = {}
+    warning_map = {}
+    for a in get_alerts():
+        host = a["host"]
+        if a["severity"] == "high":
+            alert_map[host] = a
+            status_by_host[host] = "error"
+        elif a["severity"] == "warning":
+            warning_map[host] = a
+            # 重大アラートがあるホストは error のまま
+            status_by_host.setdefault(host, "warning")
+    return status_by_host, alert_map, warning_map
+
+# アラート重要度 -> 表示アイコン（high以外は警告扱い）
+_SEVERITY_ICONS = {"high": "🔴", "warning": "🟡"}
 
 def get_server_status_summary():
     """サーバーステータスのサマリーを取得"""
     hosts = get_hosts()
-    alerts = get_alerts()
-    
-    alert_hosts = set(a["host"] for a in alerts if a["severity"] == "high")
-    warning_hosts = set(a["host"] for a in alerts if a["severity"] == "warning")
-    
-    ok_count = 0
-    warn_count = 0
-    error_count = 0
-    
-    for host_id, host in hosts.items():
-        if host_id in alert_hosts:
-            error_count += 1
-        elif host_id in warning_hosts:
-            warn_count += 1
-        else:
-            ok_count += 1
+    status_by_host, _, _ = _alert_index(_mock_data_mtime())
+    counts = Counter(status_by_host.get(host_id, "ok") for host_id in hosts)
     
     return {
-        "ok": ok_count,
-        "warning": warn_count,
-        "error": error_count,
+        "ok": counts["ok"],
+        "warning": counts["warning"],
+        "error": counts["error"],
         "total": len(hosts)
     }
 
+def _mock_data_mtime() -> float:
+    """モックデータの更新時刻（派生キャッシュのキーに使う）"""
+    return _file_mtime(MOCK_DATA_PATH) or 0.0
+
+@st.cache_data(show_spinner=False)
+def _metric_index(mtime: float) -> dict:
+    """メトリクスごとに値の昇順で並べた (値の配列, ホストIDの配列) を作る"""
+    columns_by_metric = {}
+    for pos, (host_id, host) in enumerate(get_hosts().items()):
+        for metric, value in (host.get("metrics") or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values, positions, host_ids = columns_by_metric.setdefault(metric, ([], [], []))
+                values.append(value)
+                positions.append(pos)
+                host_ids.append(host_id)
+    
+    index = {}
+    for metric, (values, positions, host_ids) in columns_by_metric.items():
+        values = np.array(values, dtype=np.float64)
+        # 同値は元の並び順を保ったまま降順に取り出せるよう、位置の降順を第2キーにする
+        order = np.lexsort((-np.array(positions), values))
+        index[metric] = (values[order], np.array(host_ids, dtype=object)[order])
+    return index
+
+_EMPTY_METRIC_INDEX = (np.empty(0, dtype=np.float64), np.empty(0, dtype=object))
+
+# 比較演算子 -> 昇順の値配列上で条件を満たす範囲 [lo, hi) を二分探索で求める関数
+_OPERATOR_RANGES = {
+    ">": lambda values, v: (np.searchsorted(values, v, side="right"), len(values)),
+    ">=": lambda values, v: (np.searchsorted(values, v, side="left"), len(values)),
+    "<": lambda values, v: (0, np.searchsorted(values, v, side="left")),
+    "<=": lambda values, v: (0, np.searchsorted(values, v, side="right")),
+    "=": lambda values, v: (np.searchsorted(values, v, side="left"), np.searchsorted(values, v, side="right")),
+}
+
 def get_hosts_by_condition(metric: str, operator: str, value: float) -> list:
-    """条件に合うホストを取得"""
+    """条件に合うホストを取得（値の降順）"""
+    return _get_hosts_by_condition(get_hosts(), metric, operator, value)
+
+def _get_hosts_by_condition(hosts: dict, metric: str, operator: str, value: float) -> list:
+    values, host_ids = _metric_index(_mock_data_mtime()).get(metric, _EMPTY_METRIC_INDEX)
+    
+    find_range = _OPERATOR_RANGES.get(operator)
+    lo, hi = find_range(values, value) if find_range else (0, 0)
+    
+    # 範囲はスライスでまとめて取り出し、降順に並べ替えるだけ
+    return [
+        {"host_id": host_id, **hosts[host_id], "current_value": current}
+        for host_id, current in zip(host_ids[lo:hi][::-1], values[lo:hi][::-1].tolist())
+    ]
+
+# ホストとアラートを突き合わせた1行分（alertは該当するアラート、無ければNone）
+HostStatus = namedtuple("HostStatus", ["host_id", "host", "status", "alert"])
+
+def _iter_hosts_with_status():
+    """全ホストをステータス付きで列挙する（アラートとの突き合わせは1回だけ）"""
     hosts = get_hosts()
-    results = []
+    status_by_host, alert_hosts, warning_hosts = _alert_index(_mock_data_mtime())
     for host_id, host in hosts.items():
-        if metric in host.get("metrics", {}):
-            current_value = host["metrics"][metric]
-            match = False
-            if operator == ">" and current_value > value:
-                match = True
-            elif operator == ">=" and current_value >= value:
-                match = True
-            elif operator == "<" and current_value < value:
-                match = True
-            elif operator == "<=" and current_value <= value:
-                match = True
-            elif operator == "=" and current_value == value:
-                match = True
-            if match:
-                results.append({"host_id": host_id, **host, "current_value": current_value})
-    return sorted(results, key=lambda x: x["current_value"], reverse=True)
+        status = status_by_host.get(host_id, "ok")
+        alert = alert_hosts.get(host_id) if status == "error" else warning_hosts.get(host_id)
+        yield HostStatus(host_id, host, status, alert)
+
+def get_hosts_by_statuses(statuses) -> list:
+    """複数ステータスのホストを1回の走査で取得（statusesの順にまとめて返す）"""
+    grouped = {status: [] for status in statuses}
+    for r in _iter_hosts_with_status():
+        rows = grouped.get(r.status)
+        if rows is not None:
+            if r.alert is None:
+                rows.append({"host_id": r.host_id, **r.host})
+            else:
+                rows.append({"host_id": r.host_id, **r.host, "alert": r.alert})
+    return [row for rows in grouped.values() for row in rows]
 
 def get_hosts_by_status(status: str) -> list:
     """ステータス別にホストを取得"""
-    hosts = get_hosts()
-    alerts = get_alerts()
-    
-    alert_hosts = {a["host"]: a for a in alerts if a["severity"] == "high"}
-    warning_hosts = {a["host"]: a for a in alerts if a["severity"] == "warning"}
-    
-    results = []
-    for host_id, host in hosts.items():
-        if status == "error" and host_id in alert_hosts:
-            results.append({"host_id": host_id, **host, "alert": alert_hosts[host_id]})
-        elif status == "warning" and host_id in warning_hosts and host_id not in alert_hosts:
-            results.append({"host_id": host_id, **host, "alert": warning_hosts[host_id]})
-        elif status == "ok" and host_id not in alert_hosts and host_id not in warning_hosts:
-            results.append({"host_id": host_id, **host})
-        elif status == "all":
-            host_status = "error" if host_id in alert_hosts else "warning" if host_id in warning_hosts else "ok"
-            results.append({"host_id": host_id, **host, "status": host_status})
-    return results
+    if status == "all":
+        return [{"host_id": r.host_id, **r.host, "status": r.status} for r in _iter_hosts_with_status()]
+    return get_hosts_by_statuses((status,))
+
+def count_hosts_over(metric: str, threshold: float) -> int:
+    """メトリクスが閾値を超えるホスト数を取得"""
+    values, _ = _metric_index(_mock_data_mtime()).get(metric, _EMPTY_METRIC_INDEX)
+    return int(len(values) - np.searchsorted(values, threshold, side="right"))
 
 def get_host_metrics(host_id: str) -> dict:
     """ホストのメトリクスを取得"""
-    hosts = get_hosts()
+    return _get_host_metrics(get_hosts(), host_id)
+
+def _get_host_metrics(hosts: dict, host_id: str) -> dict:
     if host_id in hosts:
         return hosts[host_id].get("metrics", {})
     return {}
 
-def generate_metrics_history(host_id: str, metric: str, hours: int = 24) -> list:
+def _mock_metric_values(rng: np.random.Generator, base_value: float, hour_of_day: np.ndarray) -> np.ndarray:
+    """時刻(時)の配列からモックのメトリクス値(0〜100, 小数1桁)の配列を生成する"""
+    n = len(hour_of_day)
+    # 14〜16時台は負荷のスパイクを乗せる
+    spike = np.where((hour_of_day >= 14) & (hour_of_day <= 16), rng.uniform(20, 40, size=n), 0.0)
+    return np.clip(base_value + rng.uniform(-10, 10, size=n) + spike, 0, 100).round(1)
+
+@st.cache_data(ttl=60, max_entries=128, show_spinner=False)
+def generate_metrics_history(host_id: str, metric: str, hours: int = 24):
     """メトリクス履歴を生成（モック）"""
     hosts = get_hosts()
-    base_value = hosts.get(host_id, {}).get("metrics", {}).get(metric, 50)
-    history = []
-    now = datetime.now()
-    
-    for i in range(hours * 6):
-        timestamp = now - timedelta(minutes=10 * (hours * 6 - i))
-        hour = timestamp.hour
-        if 14 <= hour <= 16:
-            spike = random.uniform(20, 40)
-        else:
-            spike = 0
-        value = base_value + random.uniform(-10, 10) + spike
-        value = max(0, min(100, value))
-        history.append({
-            "timestamp": timestamp,
-            "value": round(value, 1)
-        })
-    return history
+    base_value = (hosts.get(host_id, _EMPTY).get("metrics") or _EMPTY).get(metric, 50)
+    
+    # 10分間隔のタイムスタンプ（最新が現在の10分前）
+    timestamps = pd.date_range(end=datetime.now() - timedelta(minutes=10), periods=hours * 6, freq="10min")
+    values = _mock_metric_values(np.random.default_rng(), base_value, timestamps.hour.to_numpy())
+    
+    return pd.DataFrame({"timestamp": timestamps, "value": values})
+
+# (ベンダー, デバイスタイプ) -> 適用テンプレート
+# ベンダーが "default" のエントリは、そのデバイスタイプ全体のフォールバックとして扱う
+TEMPLATE_MAP = {
+    ("Cisco", "ROUTER"): ("Template Cisco IOS-XE SNMP", "Template ICMP Ping"),
+    ("Cisco", "SWITCH"): ("Template Cisco Catalyst SNMP", "Template ICMP Ping"),
+    ("Juniper", "FIREWALL"): ("Template Juniper SRX SNMP", "Template ICMP Ping"),
+    ("default", "ACCESS_POINT"): ("Template Generic SNMP AP", "Template ICMP Ping"),
+}
+
+_DEFAULT_TEMPLATES = ("Template ICMP Ping",)
+
+# フォールバックを ("*", デバイスタイプ) キーとして展開済みのルックアップテーブル
+TEMPLATES_BY_KEY = {
+    **TEMPLATE_MAP,
+    **{("*", dtype): templates for (vendor, dtype), templates in TEMPLATE_MAP.items() if vendor == "default"},
+}
+
+def lookup_templates(vendor: str, device_type: str) -> tuple:
+    """ベンダーとデバイスタイプに対応するテンプレートを取得"""
+    return (TEMPLATES_BY_KEY.get((vendor, device_type))
+            or TEMPLATES_BY_KEY.get(("*", device_type))
+            or _DEFAULT_TEMPLATES)
+
+def _tag(tag: str, value: str) -> dict:
+    """Zabbixのタグ定義を生成"""
+    return {"tag": tag, "value": value}
 
 def generate_zabbix_config(topology: dict) -> dict:
     """トポロジーからZabbix設定を生成"""
@@ -192,140 +305,377 @@ def generate_zabbix_config(topology: dict) -> dict:
         "triggers": [],
         "dependencies": []
     }
+    hosts = config["hosts"]
+    triggers = config["triggers"]
+    dependencies = config["dependencies"]
     
     layers = set()
     vendors = set()
     locations = set()
     ha_groups = set()
     
+    # トポロジーを1回だけ走査し、グループ・ホスト・トリガー・依存関係を同時に組み立てる
     for host_id, host_data in topology.items():
-        layers.add(f"Layer{host_data['layer']}")
-        if host_data.get("metadata", {}).get("vendor"):
-            vendors.add(host_data["metadata"]["vendor"])
-        if host_data.get("metadata", {}).get("location"):
-            locations.add(host_data["metadata"]["location"])
-        if host_data.get("redundancy_group"):
-            ha_groups.add(host_data["redundancy_group"])
-            
-    config["host_groups"] = [
-        *[{"name": f"Network/{layer}", "type": "layer"} for layer in sorted(layers)],
-        *[{"name": f"Vendor/{vendor}", "type": "vendor"} for vendor in vendors],
-        *[{"name": f"Location/{loc}", "type": "location"} for loc in locations],
-        *[{"name": f"HA_Groups/{group}", "type": "ha"} for group in ha_groups]
-    ]
-    
-    template_map = {
-        ("Cisco", "ROUTER"): ["Template Cisco IOS-XE SNMP", "Template ICMP Ping"],
-        ("Cisco", "SWITCH"): ["Template Cisco Catalyst SNMP", "Template ICMP Ping"],
-        ("Juniper", "FIREWALL"): ["Template Juniper SRX SNMP", "Template ICMP Ping"],
-        ("default", "ACCESS_POINT"): ["Template Generic SNMP AP", "Template ICMP Ping"],
-    }
-    
-    for host_id, host_data in topology.items():
-        vendor = host_data.get("metadata", {}).get("vendor", "default")
+        meta = host_data.get("metadata") or _EMPTY
+        vendor = meta.get("vendor", "default")
+        location = meta.get("location")
+        model = meta.get("model")
+        hw = meta.get("hw_inventory") or _EMPTY
+        layer = host_data["layer"]
         device_type = host_data.get("type", "unknown")
+        rg = host_data.get("redundancy_group")
         
-        templates = template_map.get((vendor, device_type), 
-                    template_map.get(("default", device_type), ["Template ICMP Ping"]))
+        layer_group = f"Layer{layer}"
+        layers.add(layer_group)
         
-        groups = [f"Network/Layer{host_data['layer']}"]
+        # グループ一覧は値のあるベンダーすべて、ホスト側は "default" 以外のみ（元の仕様どおり）
+        if meta.get("vendor"):
+            vendors.add(vendor)
+        
+        groups = [f"Network/{layer_group}"]
         if vendor != "default":
             groups.append(f"Vendor/{vendor}")
-        if host_data.get("metadata", {}).get("location"):
-            groups.append(f"Location/{host_data['metadata']['location']}")
-        if host_data.get("redundancy_group"):
-            groups.append(f"HA_Groups/{host_data['redundancy_group']}")
+        if location:
+            locations.add(location)
+            groups.append(f"Location/{location}")
+        if rg:
+            ha_groups.add(rg)
+            groups.append(f"HA_Groups/{rg}")
+        
+        tags = [("layer", str(layer)), ("type", device_type)]
+        if vendor != "default":
+            tags.append(("vendor", vendor))
+        if model:
+            tags.append(("model", model))
         
         host_config = {
             "host_id": host_id,
             "name": host_id,
             "groups": groups,
-            "templates": templates,
-            "tags": [
-                {"tag": "layer", "value": str(host_data["layer"])},
-                {"tag": "type", "value": device_type},
-            ],
+            "templates": list(lookup_templates(vendor, device_type)),
+            "tags": [_tag(t, v) for t, v in tags],
             "macros": {}
         }
         
-        if vendor != "default":
-            host_config["tags"].append({"tag": "vendor", "value": vendor})
-        if host_data.get("metadata", {}).get("model"):
-            host_config["tags"].append({"tag": "model", "value": host_data["metadata"]["model"]})
-        if host_data.get("metadata", {}).get("hw_inventory", {}).get("psu_count"):
-            host_config["macros"]["{$PSU_COUNT}"] = host_data["metadata"]["hw_inventory"]["psu_count"]
+        if hw.get("psu_count"):
+            host_config["macros"]["{$PSU_COUNT}"] = hw["psu_count"]
             
-        config["hosts"].append(host_config)
+        hosts.append(host_config)
         
         if host_data.get("parent_id"):
-            config["dependencies"].append({
+            dependencies.append({
                 "host": host_id,
                 "depends_on": host_data["parent_id"],
                 "type": "parent"
             })
-    
-    for host_id, host_data in topology.items():
-        device_type = host_data.get("type", "unknown")
         
-        config["triggers"].append({
+        triggers.append({
             "host": host_id,
             "name": f"{host_id} is unreachable",
             "expression": f"nodata(/{host_id}/icmp.ping,5m)=1",
-            "severity": "high" if host_data["layer"] <= 2 else "average"
+            "severity": "high" if layer <= 2 else "average"
         })
         
         if device_type in ["ROUTER", "SWITCH", "FIREWALL"]:
-            config["triggers"].append({
+            triggers.append({
                 "host": host_id,
                 "name": f"{host_id} CPU usage is high",
                 "expression": f"last(/{host_id}/system.cpu.util)>80",
                 "severity": "warning"
             })
             
-        if host_data.get("redundancy_group"):
-            config["triggers"].append({
+        if rg:
+            triggers.append({
                 "host": host_id,
                 "name": f"HA Failover detected - {host_id}",
                 "expression": f"change(/{host_id}/ha.role,1h)<>0",
                 "severity": "warning"
             })
     
+    config["host_groups"] = [
+        *[{"name": f"Network/{layer}", "type": "layer"} for layer in sorted(layers)],
+        *[{"name": f"Vendor/{vendor}", "type": "vendor"} for vendor in vendors],
+        *[{"name": f"Location/{loc}", "type": "location"} for loc in locations],
+        *[{"name": f"HA_Groups/{group}", "type": "ha"} for group in ha_groups]
+    ]
+    
     return config
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_zabbix_config(mtime: float) -> dict:
+    """トポロジーファイルの更新時刻をキーに生成結果をキャッシュする"""
+    # dictを引数にするとStreamlitが入れ子を辿ってハッシュするため、mtimeだけをキーにする
+    return generate_zabbix_config(_load_json(TOPOLOGY_PATH, mtime))
+
+def get_generated_config():
+    """現在のトポロジーからZabbix設定を生成する（トポロジーが無ければNone）"""
+    mtime = _file_mtime(TOPOLOGY_PATH)
+    if mtime is None:
+        return None
+    return _cached_zabbix_config(mtime)
+
 # ==================== コマンドキャッシュ ====================
 
+# コマンドキャッシュの上限件数と有効期限（LRUで古いものから破棄）
+COMMAND_CACHE_MAX_ENTRIES = 256
+COMMAND_CACHE_TTL_SECONDS = 3600
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+@lru_cache(maxsize=1024)
 def get_cache_key(intent: str) -> str:
-    return hashlib.md5(intent.lower().strip().encode()).hexdigest()
+    # 全角/半角・大文字小文字・空白の揺れを吸収し、正規化した文字列をそのままキーにする
+    # NFKC正規化は安くないので、先読みと本処理・繰り返しの入力で結果を使い回す
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", intent).strip().lower())
+
+def _is_shared_entry(entry) -> bool:
+    """ファイルから読んだエントリが {"command": dict, "t": 数値} の形か"""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get("command"), dict)
+            and isinstance(entry.get("t"), (int, float))
+            and not isinstance(entry["t"], bool))
+
+def _live_shared_entries(entries: dict) -> OrderedDict:
+    """共有キャッシュのエントリから期限切れと壊れたものを除き、古い順に上限件数まで並べる"""
+    now = time.time()
+    live = sorted(
+        ((key, {"command": entry["command"], "t": entry["t"]})
+         for key, entry in entries.items()
+         if _is_shared_entry(entry) and now - entry["t"] < COMMAND_CACHE_TTL_SECONDS),
+        key=lambda item: item[1]["t"]
+    )
+    return OrderedDict(live[-COMMAND_CACHE_MAX_ENTRIES:])
+
+def _load_command_cache() -> OrderedDict:
+    """ディスクに保存した共有コマンドキャッシュ（キー→解釈結果）を読み込む
+    
+    読めない・形が違うファイルは空として扱う（保存側と同じく、キャッシュのI/Oで処理を止めない）
+    """
+    try:
+        saved = orjson.loads(Path(COMMAND_CACHE_PATH).read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return OrderedDict()
+    if not isinstance(saved, dict):
+        return OrderedDict()
+    return _live_shared_entries(saved)
+
+def save_command_cache(entries: dict, removed=()) -> OrderedDict:
+    """共有コマンドキャッシュをディスクの内容とマージして書き出し、マージ後の内容を返す
+    
+    同じキーは新しい方を残す（別プロセスが書いた分も失わない）。removed のキーはディスク側からも消す。一時ファイルは書き込みごとに
+    mkstemp で作り、置き換えで公開するので書きかけを読ませない。呼び出し側でロックを取ること
+    キーはサニタイズ済みの文字列なので、秘密情報はファイルに残らない
+    """
+    merged = dict(_load_command_cache())
+    for key, entry in entries.items():
+        if key not in merged or merged[key]["t"] < entry["t"]:
+            merged[key] = entry
+    for key in removed:
+        merged.pop(key, None)
+    merged = _live_shared_entries(merged)
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".command_cache.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(merged))
+            os.replace(tmp_path, COMMAND_CACHE_PATH)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass  # 保存できなくてもメモリ上の共有キャッシュはそのまま使う
+    return merged
+
+@st.cache_resource
+def _shared_command_store() -> dict:
+    """全セッションで共有するLLM解釈結果（プロセス起動時に1回だけディスクから復元する）
+    
+    使用回数や履歴はセッションごとに持ち、ここには解釈結果と登録時刻だけを置く
+    """
+    return {"lock": threading.Lock(), "entries": _load_command_cache()}
+
+def _shared_lookup(key: str):
+    """共有キャッシュから有効期限内の解釈結果を返す（無ければNone）"""
+    entry = _shared_command_store()["entries"].get(key)
+    if entry is None or time.time() - entry["t"] >= COMMAND_CACHE_TTL_SECONDS:
+        return None
+    return entry["command"]
+
+def _share_command(key: str, command: dict):
+    """解釈結果を共有キャッシュに登録してディスクに書き出す"""
+    store = _shared_command_store()
+    with store["lock"]:
+        entries = OrderedDict(store["entries"])
+        entries[key] = {"command": command, "t": time.time()}
+        store["entries"] = save_command_cache(entries)
+
+def forget_shared_commands(keys):
+    """指定したキーの解釈結果を共有キャッシュとディスクから取り除く（誤った解釈を使わせないため）"""
+    keys = set(keys)
+    if not keys:
+        return
+    store = _shared_command_store()
+    with store["lock"]:
+        entries = OrderedDict((k, v) for k, v in store["entries"].items() if k not in keys)
+        store["entries"] = save_command_cache(entries, removed=keys)
 
 def get_command_cache():
+    """このセッションのコマンド履歴（他のセッションの入力は含めない）"""
     if "command_cache" not in st.session_state:
-        st.session_state.command_cache = {}
+        st.session_state.command_cache = OrderedDict()
     return st.session_state.command_cache
 
-def set_command_cache(intent: str, command: dict):
-    cache = get_command_cache()
-    key = get_cache_key(intent)
+def _cache_lookup(cache: OrderedDict, key: str):
+    """有効期限内のエントリを返し、LRU順を更新する"""
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry["t"] >= COMMAND_CACHE_TTL_SECONDS:
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    entry["use_count"] += 1
+    return entry
+
+def _cache_store(cache: OrderedDict, key: str, intent: str, command: dict):
+    """エントリを登録し、上限を超えた分は最も古いものから破棄する"""
     cache[key] = {
         "intent": intent,
         "command": command,
-        "created_at": datetime.now().isoformat(),
+        "t": time.time(),
         "use_count": 1
     }
+    cache.move_to_end(key)
+    while len(cache) > COMMAND_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def _set_cache_by_key(key: str, intent: str, command: dict):
+    _cache_store(get_command_cache(), key, intent, command)
+    _share_command(key, command)
+
+def set_command_cache(intent: str, command: dict):
+    _set_cache_by_key(get_cache_key(intent), intent, command)
+
+def get_command_cache_stats() -> dict:
+    """コマンドキャッシュのヒット/ミス回数（サイドバー表示用）"""
+    if "command_cache_stats" not in st.session_state:
+        st.session_state.command_cache_stats = {"hits": 0, "misses": 0}
+    return st.session_state.command_cache_stats
+
+def _get_cached_by_key(key: str, intent: str):
+    """正規化済みキーでコマンドを引き、ヒット/ミスを数える
+    
+    セッションの履歴に無ければ共有キャッシュを見て、見つかればこのセッションの履歴にも加える
+    """
+    cache = get_command_cache()
+    entry = _cache_lookup(cache, key)
+    if entry is None:
+        command = _shared_lookup(key)
+        if command is not None:
+            _cache_store(cache, key, intent, command)
+            entry = cache[key]
+    get_command_cache_stats()["hits" if entry else "misses"] += 1
+    return entry["command"] if entry else None
 
 def get_cached_command(intent: str):
+    return _get_cached_by_key(get_cache_key(intent), intent)
+
+def is_command_cached(key: str) -> bool:
+    """セッションの履歴か共有キャッシュに解釈結果があるか（使用回数は数えない）"""
+    return key in get_command_cache() or _shared_lookup(key) is not None
+
+# ==================== 類似コマンドキャッシュ ====================
+
+# 言い換え程度の違い（助詞や語尾の揺れ）でもLLM呼び出しを省くための簡易ベクトル索引
+# 埋め込みモデルは使わず、文字n-gramをハッシュした頻度ベクトルのコサイン類似度で判定する
+# 内容語はシグネチャで完全一致させるので、類似度が見るのはひらがな部分（助詞・語尾）の揺れだけ
+SIMILAR_CACHE_DIM = 1024
+SIMILAR_CACHE_THRESHOLD = 0.75
+
+# 数値とホスト名・メトリクス名（英数字トークン）は完全一致を要求する（CPU80%とCPU90%を混同しない）
+_SIGNATURE_RE = re.compile(r'\d+|[a-z]+')
+# 漢字・カタカナの語（有効化/無効化、一覧/統計など）も一致を要求する
+_CONTENT_WORD_RE = re.compile(r'[一-龯々]+|[ァ-ヴー]+')
+# 否定はひらがなで表れるので、有無だけはシグネチャに含める
+_NEGATION_RE = re.compile(r'ない|なく|ません|なし')
+# 類似度の計算からは英数字トークンを除く（長いホスト名が一致するだけで類似度が高止まりするため）
+_ASCII_TOKEN_RE = re.compile(r'[a-z0-9_-]+')
+
+def _key_signature(key: str) -> tuple:
+    """類似とみなす前提として一致が必要な要素（英数字トークン・内容語・否定の有無・キーワード分類）"""
+    return (
+        _SIGNATURE_RE.findall(key),
+        frozenset(_CONTENT_WORD_RE.findall(key)),
+        bool(_NEGATION_RE.search(key)),
+        {_KEYWORD_TAGS[kw] for kw in _KEYWORD_RE.findall(key)},
+    )
+
+def _embed_key(key: str) -> np.ndarray:
+    """正規化済みキーを、英数字トークンを除いた文字unigram+bigramのハッシュでL2正規化ベクトルにする"""
+    text = _ASCII_TOKEN_RE.sub("", key).replace(" ", "")
+    grams = [*text, *(text[i:i + 2] for i in range(len(text) - 1))] or [key]
+    vec = np.bincount([hash(g) % SIMILAR_CACHE_DIM for g in grams], minlength=SIMILAR_CACHE_DIM).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+def _get_similar_index() -> dict:
+    """類似検索用の索引（行列は行単位で追記し、足りなくなったら倍に拡張する）"""
+    if "similar_index" not in st.session_state:
+        st.session_state.similar_index = {
+            "keys": [],
+            "signatures": [],
+            "rows": {},
+            "matrix": np.zeros((64, SIMILAR_CACHE_DIM), dtype=np.float32),
+        }
+    return st.session_state.similar_index
+
+def _similar_index_add(key: str):
+    index = _get_similar_index()
+    if key in index["rows"]:
+        return
+    # 破棄済みのキーが溜まったら、キャッシュに残っているものだけで作り直す
+    if len(index["keys"]) >= 2 * COMMAND_CACHE_MAX_ENTRIES:
+        live = [k for k in index["keys"] if k in get_command_cache()]
+        st.session_state.pop("similar_index")
+        for k in live:
+            _similar_index_add(k)
+        index = _get_similar_index()
+    n = len(index["keys"])
+    if n == len(index["matrix"]):
+        index["matrix"] = np.concatenate([index["matrix"], np.zeros_like(index["matrix"])])
+    index["matrix"][n] = _embed_key(key)
+    index["keys"].append(key)
+    index["signatures"].append(_key_signature(key))
+    index["rows"][key] = n
+
+def remember_similar_command(key: str):
+    """LLMで解釈できたコマンド（正規化済みキー）を類似検索の対象に加える"""
+    _similar_index_add(key)
+
+def get_similar_cached_command(key: str):
+    """完全一致しなかったとき、十分に似たキャッシュ済みコマンドを返す（無ければNone）
+    
+    別の入力に対する結果なので、呼び出し側は近似ヒットとして扱うこと
+    """
+    index = st.session_state.get("similar_index")
+    if not index or not index["keys"]:
+        return None
+    signature = _key_signature(key)
+    sims = index["matrix"][:len(index["keys"])] @ _embed_key(key)
     cache = get_command_cache()
-    key = get_cache_key(intent)
-    if key in cache:
-        cache[key]["use_count"] += 1
-        return cache[key]["command"]
+    for i in np.argsort(sims)[::-1]:
+        if sims[i] < SIMILAR_CACHE_THRESHOLD:
+            break
+        if index["signatures"][i] == signature:
+            entry = _cache_lookup(cache, index["keys"][i])
+            if entry:
+                return entry["command"]
     return None
 
 # ==================== 設定表示ヘルパー ====================
 
-def display_config_summary(config: dict):
-    """設定を人が読みやすい形式で表示"""
-    import pandas as pd
-    
+def display_config_summary(config: dict, key: str):
+    """設定を人が読みやすい形式で表示（key はメッセージごとに一意なウィジェットキー）"""
     tab1, tab2 = st.tabs(["📊 サマリー表示", "📄 JSON表示"])
     
     with tab1:
@@ -335,50 +685,45 @@ def display_config_summary(config: dict):
             st.dataframe(groups_df, use_container_width=True, hide_index=True)
         
         st.subheader("🖥️ ホスト設定")
-        if config.get("hosts"):
-            hosts_data = []
-            for host in config["hosts"]:
-                hosts_data.append({
-                    "ホスト名": host.get("host_id", ""),
-                    "グループ": ", ".join(host.get("groups", [])),
-                    "テンプレート": ", ".join(host.get("templates", [])),
-                })
-            hosts_df = pd.DataFrame(hosts_data)
+        # 行ごとのdictは作らず、列ごとのリストから1回でDataFrameを組み立てる
+        hosts = config.get("hosts")
+        if hosts:
+            hosts_df = pd.DataFrame({
+                "ホスト名": [host.get("host_id", "") for host in hosts],
+                "グループ": [", ".join(host.get("groups", [])) for host in hosts],
+                "テンプレート": [", ".join(host.get("templates", [])) for host in hosts],
+            })
             st.dataframe(hosts_df, use_container_width=True, hide_index=True)
         
         st.subheader("⚡ トリガー")
-        if config.get("triggers"):
-            triggers_data = []
-            for trigger in config["triggers"]:
-                triggers_data.append({
-                    "ホスト": trigger.get("host", ""),
-                    "トリガー名": trigger.get("name", ""),
-                    "重要度": trigger.get("severity", ""),
-                })
-            triggers_df = pd.DataFrame(triggers_data)
+        triggers = config.get("triggers")
+        if triggers:
+            triggers_df = pd.DataFrame({
+                "ホスト": [trigger.get("host", "") for trigger in triggers],
+                "トリガー名": [trigger.get("name", "") for trigger in triggers],
+                "重要度": [trigger.get("severity", "") for trigger in triggers],
+            })
             st.dataframe(triggers_df, use_container_width=True, hide_index=True)
         
         st.subheader("🔗 依存関係")
-        if config.get("dependencies"):
-            deps_data = []
-            for dep in config["dependencies"]:
-                deps_data.append({
-                    "ホスト": dep.get("host", ""),
-                    "依存先": dep.get("depends_on", ""),
-                    "タイプ": dep.get("type", ""),
-                })
-            deps_df = pd.DataFrame(deps_data)
+        deps = config.get("dependencies")
+        if deps:
+            deps_df = pd.DataFrame({
+                "ホスト": [dep.get("host", "") for dep in deps],
+                "依存先": [dep.get("depends_on", "") for dep in deps],
+                "タイプ": [dep.get("type", "") for dep in deps],
+            })
             st.dataframe(deps_df, use_container_width=True, hide_index=True)
     
     with tab2:
-        st.json(config)
+        # 大きな設定を毎回シリアライズしないよう、表示を求められたときだけJSON化する
+        if st.checkbox("JSONを表示", key=f"render_json_{key}"):
+            st.code(orjson.dumps(config, option=orjson.OPT_INDENT_2).decode(), language="json")
 
 # ==================== サーバー情報ダイアログ ====================
 
 def show_server_info_dialog():
     """サーバー情報ダイアログを表示"""
-    import pandas as pd
-    
     st.subheader("📊 サーバー情報")
     
     tab_a, tab_b, tab_c = st.tabs([
@@ -452,7 +797,7 @@ def show_server_info_dialog():
                 results = get_hosts_by_status("error")
                 st.write("**🔴 異常サーバー一覧**")
             elif filter_type == "warning_up":
-                results = get_hosts_by_status("error") + get_hosts_by_status("warning")
+                results = get_hosts_by_statuses(("error", "warning"))
                 st.write("**🟡 警告以上のサーバー一覧**")
             elif filter_type == "ok":
                 results = get_hosts_by_status("ok")
@@ -486,13 +831,12 @@ def show_server_info_dialog():
     
     # === タブB: カード形式ダッシュボード ===
     with tab_b:
-        hosts = get_hosts()
         alerts = get_alerts()
         
         # メトリクス別カウント
-        cpu_high = len([h for h in hosts.values() if h.get("metrics", {}).get("cpu", 0) > 80])
-        mem_high = len([h for h in hosts.values() if h.get("metrics", {}).get("memory", 0) > 80])
-        disk_high = len([h for h in hosts.values() if h.get("metrics", {}).get("disk", 0) > 80])
+        cpu_high = count_hosts_over("cpu", 80)
+        mem_high = count_hosts_over("memory", 80)
+        disk_high = count_hosts_over("disk", 80)
         
         col1, col2, col3 = st.columns(3)
         
@@ -526,8 +870,10 @@ def show_server_info_dialog():
         col4, col5 = st.columns(2)
         with col4:
             st.markdown("### ⚡ アラート")
-            high_alerts = len([a for a in alerts if a["severity"] == "high"])
-            warn_alerts = len([a for a in alerts if a["severity"] == "warning"])
+            # 重要度ごとの件数は1回の走査でまとめて数える
+            severity_counts = Counter(a["severity"] for a in alerts)
+            high_alerts = severity_counts["high"]
+            warn_alerts = severity_counts["warning"]
             if high_alerts > 0:
                 st.error(f"重大: {high_alerts}件")
             if warn_alerts > 0:
@@ -559,8 +905,7 @@ def show_server_info_dialog():
             elif detail == "alerts":
                 st.write("**アラート一覧**")
                 for a in alerts:
-                    icon = "🔴" if a["severity"] == "high" else "🟡"
-                    st.write(f"{icon} **{a['host']}**: {a['message']}")
+                    st.write(f"{_SEVERITY_ICONS.get(a['severity'], '🟡')} **{a['host']}**: {a['message']}")
     
     # === タブC: クイック質問 ===
     with tab_c:
@@ -678,6 +1023,43 @@ SENSITIVE_PATTERNS = [
     (r'(mysql|postgres|mongodb|redis)://[^\s]+', r'\1://***REDACTED***', re.IGNORECASE),
 ]
 
+def _classify_pattern(pattern: str, replacement: str) -> str:
+    """パターンと置換文字列から、検出される秘密情報の種類を判定する"""
+    if 'password' in pattern.lower() or 'passwd' in pattern.lower() or 'パスワード' in pattern:
+        return "パスワード"
+    elif 'api' in pattern.lower() or 'secret' in pattern.lower() or 'token' in pattern.lower():
+        return "APIキー/トークン"
+    elif 'card' in replacement.lower():
+        return "クレジットカード番号"
+    elif 'ssn' in replacement.lower():
+        return "社会保障番号"
+    elif 'mynumber' in replacement.lower():
+        return "マイナンバー"
+    elif 'aws' in pattern.lower():
+        return "AWS認証情報"
+    elif 'private' in replacement.lower():
+        return "秘密鍵"
+    elif 'mysql' in pattern.lower() or 'postgres' in pattern.lower():
+        return "データベース接続情報"
+    else:
+        return "認証情報"
+
+# (コンパイル済みパターン, 置換文字列, 検出種別) の一覧（import時に1回だけ構築）
+_COMPILED_PATTERNS = [
+    (re.compile(t[0], t[2] if len(t) == 3 else re.IGNORECASE), t[1], _classify_pattern(t[0], t[1]))
+    for t in SENSITIVE_PATTERNS
+]
+
+# 全パターンを1本のalternationにまとめたもの（秘密情報を含まない大半のメッセージを1回の走査で判定する）
+# パターン同士が重なるため置換自体は順番に行う（まとめて置換すると先に一致した側だけが置換され、残りが漏れる）
+_ANY_SENSITIVE_RE = re.compile(
+    "|".join(f"(?:{t[0]})" for t in SENSITIVE_PATTERNS),
+    re.IGNORECASE
+)
+
+# どのパターンも最低1つは含む文字・語（区切り記号、数字、固定の接頭辞）。これが無ければ秘密情報は含まれない
+_SENSITIVE_HINT_RE = re.compile(r'[=:：\d]|bearer|token|jwt|basic|a(?:ki|bi|cc|si)a|-----begin', re.IGNORECASE)
+
 def sanitize_message(message: str) -> tuple[str, list[str]]:
     """
     メッセージから秘密情報を除去する
@@ -685,55 +1067,91 @@ def sanitize_message(message: str) -> tuple[str, list[str]]:
     Returns:
         tuple: (サニタイズ済みメッセージ, 検出された秘密情報の種類リスト)
     """
+    # 安価な文字チェックで大半の会話文を先に除外し、残りも1回の走査で判定する
+    # どのパターンにも一致しなければ、順番に置換しても結果は変わらない
+    if not _SENSITIVE_HINT_RE.search(message) or not _ANY_SENSITIVE_RE.search(message):
+        return message, []
+    
     sanitized = message
-    detected = []
+    detected: set[str] = set()  # 種類の重複はsetで除去する
     
-    for pattern_tuple in SENSITIVE_PATTERNS:
-        if len(pattern_tuple) == 3:
-            pattern, replacement, flags = pattern_tuple
-            regex = re.compile(pattern, flags)
-        else:
-            pattern, replacement = pattern_tuple
-            regex = re.compile(pattern, re.IGNORECASE)
-        
-        if regex.search(sanitized):
+    for regex, replacement, label in _COMPILED_PATTERNS:
+        sanitized, count = regex.subn(replacement, sanitized)
+        if count:
             # 検出された秘密情報の種類を記録
-            if 'password' in pattern.lower() or 'passwd' in pattern.lower() or 'パスワード' in pattern:
-                detected.append("パスワード")
-            elif 'api' in pattern.lower() or 'secret' in pattern.lower() or 'token' in pattern.lower():
-                detected.append("APIキー/トークン")
-            elif 'card' in replacement.lower():
-                detected.append("クレジットカード番号")
-            elif 'ssn' in replacement.lower():
-                detected.append("社会保障番号")
-            elif 'mynumber' in replacement.lower():
-                detected.append("マイナンバー")
-            elif 'aws' in pattern.lower():
-                detected.append("AWS認証情報")
-            elif 'private' in replacement.lower():
-                detected.append("秘密鍵")
-            elif 'mysql' in pattern.lower() or 'postgres' in pattern.lower():
-                detected.append("データベース接続情報")
-            else:
-                detected.append("認証情報")
-            
-            sanitized = regex.sub(replacement, sanitized)
-    
-    # 重複を除去
-    detected = list(set(detected))
+            detected.add(label)
     
-    return sanitized, detected
+    return sanitized, list(detected)
 
-def call_gemini(user_message: str) -> dict:
-    """Google AI Studio APIを呼び出す（エラー時はモック応答）"""
-    
-    # ★ サニタイズ処理
-    sanitized_message, detected_secrets = sanitize_message(user_message)
-    
-    # 秘密情報が検出された場合、警告をセッションに保存
-    if detected_secrets:
-        st.session_state.sanitize_warning = detected_secrets
+# モック応答・LLM応答の解析で使う正規表現（毎回のコンパイルを避けるため事前に用意）
+_HOST_RE = re.compile(r'([A-Za-z][A-Za-z0-9_-]+)')
+_DURATION_RE = re.compile(r'(\d+)\s*(分|時間|hour|min)')
+_PCT_RE = re.compile(r'(\d+)\s*%?')
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json(text: str):
+    """テキスト中の最初の「{」からJSONオブジェクトを1つ取り出す（未完結・不正ならNone）
     
+    貪欲な正規表現と違い、後ろに説明文が続いても線形時間で読み取れる
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    try:
+        obj, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    return obj
+
+def _iter_json_objects(text: str):
+    """テキスト中に並んだJSONオブジェクトを先頭から順に取り出す（1行1つでも整形済みでもよい）"""
+    start = text.find("{")
+    while start >= 0:
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            end = start + 1
+        else:
+            yield obj
+        start = text.find("{", end)
+
+def _iter_streamed_json_objects(pieces):
+    """ストリームの断片からJSONオブジェクトを、閉じた時点で1つずつ取り出す"""
+    text = ""
+    pos = 0
+    for piece in pieces:
+        text += piece
+        start = text.find("{", pos)
+        while start >= 0:
+            try:
+                obj, pos = _JSON_DECODER.raw_decode(text, start)
+            except ValueError:
+                break  # まだ閉じていないので続きを待つ
+            yield obj
+            start = text.find("{", pos)
+    # 最後まで閉じなかった "{" は読み飛ばし、その後ろに残ったものを取り出す
+    yield from _iter_json_objects(text[pos:])
+
+@st.cache_resource
+def _http_session() -> requests.Session:
+    """Gemini APIへの接続を再利用するためのセッション（TCP/TLSハンドシェイクを省く）"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    return session
+
+def _iter_gemini_stream(response: requests.Response):
+    """streamGenerateContent(SSE)のレスポンスからテキスト断片を順に取り出す"""
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        chunk = orjson.loads(line[5:])
+        for candidate in chunk.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                if "text" in part:
+                    yield part["text"]
+
+def _get_api_key() -> str:
     api_key = ""
     try:
         if hasattr(st, 'secrets') and "GOOGLE_API_KEY" in st.secrets:
@@ -743,215 +1161,517 @@ def call_gemini(user_message: str) -> dict:
     
     if not api_key:
         api_key = os.getenv("GOOGLE_API_KEY", "")
-    
-    if not api_key:
-        return generate_mock_response(sanitized_message)  # サニタイズ済みを使用
-    
-    try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemma-3-12b-it:generateContent?key={api_key}"
-        
-        system_prompt = """あなたはZabbix監視システムのAIアシスタントです。
+    return api_key
+
+# 呼び出しごとに変わらない部分（URL・システムプロンプト・生成設定）は1回だけ組み立てておく
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemma-3-12b-it:streamGenerateContent?alt=sse"
+
+GEMINI_SYSTEM_PROMPT = """あなたはZabbix監視システムのAIアシスタントです。
 ユーザーの意図を解析し、以下のJSON形式で応答してください:
 {"intent": "意図", "action": "アクション名", "parameters": {パラメータ}}
 
 アクション: generate_config, set_maintenance, search_hosts, get_metrics, get_alerts, show_graph"""
-        
-        payload = {
-            "contents": [{"parts": [{"text": f"{system_prompt}\n\nユーザー: {sanitized_message}"}]}],  # サニタイズ済みを使用
-            "generationConfig": {"temperature": 0.7, "maxOutputTokens": 1024}
-        }
-        
-        response = requests.post(url, json=payload, timeout=15)
-        response.raise_for_status()
-        result = response.json()
-        
-        text = result["candidates"][0]["content"]["parts"][0]["text"]
-        json_match = re.search(r'\{[\s\S]*\}', text)
-        if json_match:
-            return json.loads(json_match.group())
+
+_GEMINI_GENERATION_CONFIG = {"temperature": 0.7, "maxOutputTokens": 1024}
+
+def _open_gemini_stream(session: requests.Session, api_key: str, user_part: str) -> requests.Response:
+    """システムプロンプトにユーザー入力部分を続けて、ストリーミング応答を開く"""
+    payload = {
+        "contents": [{"parts": [{"text": f"{GEMINI_SYSTEM_PROMPT}\n\n{user_part}"}]}],
+        "generationConfig": _GEMINI_GENERATION_CONFIG
+    }
+    
+    return session.post(
+        f"{GEMINI_STREAM_URL}&key={api_key}",
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=15,
+        stream=True
+    )
+
+def _request_gemini(session: requests.Session, api_key: str, sanitized_message: str):
+    """Gemini APIに問い合わせて意図JSONを返す（失敗時はNone）
+    
+    ワーカースレッドで実行されるため、st.* には触れないこと
+    """
+    try:
+        with _open_gemini_stream(session, api_key, f"ユーザー: {sanitized_message}") as response:  # サニタイズ済みを使用
+            response.raise_for_status()
+            text = ""
+            for piece in _iter_gemini_stream(response):
+                text += piece
+                # JSONが閉じた時点で、後続の説明文などの生成を待たずに打ち切る
+                if "}" in piece:
+                    parsed = _extract_json(text)
+                    if parsed is not None:
+                        return parsed
+                    # 入れ子の途中なので続きを待つ
+        
+        return _extract_json(text)
     except requests.exceptions.Timeout:
         pass  # タイムアウトはモック応答にフォールバック
     except Exception as e:
         pass  # その他エラーもモック応答にフォールバック
+    return None
+
+def _batch_index(obj: dict, count: int):
+    """まとめた応答の各JSONが返した問い合わせ番号（1始まり）を0始まりにする（不正ならNone）"""
+    index = obj.pop("i", None)
+    if isinstance(index, str) and index.isdigit():
+        index = int(index)
+    if isinstance(index, int) and not isinstance(index, bool) and 1 <= index <= count:
+        return index - 1
+    return None
+
+def _request_gemini_batch(session: requests.Session, api_key: str, sanitized_messages: list, on_result) -> set:
+    """複数メッセージを1回の問い合わせでまとめて解釈する
     
-    return generate_mock_response(sanitized_message)  # サニタイズ済みを使用
+    応答の並び順は信用せず、各JSONに入れさせた問い合わせ番号 "i" で対応付ける。
+    先頭の応答を全件の生成完了まで待たせないよう、JSONが届くたびに on_result(位置, 意図JSON) を呼ぶ。
+    対応付けた位置の集合を返す。番号が不正・重複したら、それ以降の応答は信用せず打ち切る
+    ワーカースレッドで実行されるため、st.* には触れないこと
+    """
+    count = len(sanitized_messages)
+    resolved = set()
+    numbered = "\n".join(f"{i}. {message}" for i, message in enumerate(sanitized_messages, 1))
+    user_part = (
+        "以下の各ユーザー入力について、1行に1つずつJSONで応答してください。"
+        '各JSONには入力の番号を "i" として含めてください'
+        '（例: {"i": 1, "intent": "意図", "action": "アクション名", "parameters": {}}）:\n'
+        f"{numbered}"
+    )
+    try:
+        with _open_gemini_stream(session, api_key, user_part) as response:
+            response.raise_for_status()
+            for obj in _iter_streamed_json_objects(_iter_gemini_stream(response)):
+                index = _batch_index(obj, count)
+                if index is None or index in resolved:
+                    break
+                resolved.add(index)
+                on_result(index, obj)
+    except Exception:
+        pass  # 残りは個別の問い合わせにフォールバック
+    return resolved
 
-def generate_mock_response(user_message: str) -> dict:
-    """パターンマッチングによるモック応答"""
-    message_lower = user_message.lower()
+@st.cache_resource
+def _llm_pool() -> ThreadPoolExecutor:
+    """LLM呼び出しをスクリプト実行スレッドから切り離すためのワーカープール"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def _submit_gemini(sanitized_message: str, api_key: str) -> Future:
+    """LLM呼び出しをワーカーに投入する（同じメッセージが処理中か、先読み済みならそれを再利用）"""
+    futures = st.session_state.setdefault("llm_futures", {})
+    future = futures.get(sanitized_message)
+    # 失敗に終わった先読み結果は使い回さず、問い合わせ直す
+    if future is not None and future.done() and (future.exception() is not None or future.result() is None):
+        future = None
+    if future is None:
+        future = _llm_pool().submit(_request_gemini, _http_session(), api_key, sanitized_message)
+        futures[sanitized_message] = future
+    return future
+
+# 定型コマンドをまとめて問い合わせるときの1回あたりの上限件数
+LLM_BATCH_MAX = 8
+
+def _submit_gemini_batch(sanitized_messages: list, api_key: str):
+    """複数メッセージを1回のLLM呼び出しで投入し、メッセージごとのFutureに結果を振り分ける
     
-    if "トポロジー" in message_lower and ("設定" in message_lower or "監視" in message_lower):
-        return {"intent": "トポロジーからZabbix設定を生成", "action": "generate_config", "parameters": {}}
+    各Futureは自分の応答が届いた時点で完了する。まとめた応答から取り出せなかったメッセージは、
+    個別の問い合わせで埋める
+    """
+    futures = st.session_state.setdefault("llm_futures", {})
+    children = {message: Future() for message in sanitized_messages}
+    futures.update(children)
+    session = _http_session()
+    pool = _llm_pool()
+    
+    def _resolve(index: int, parsed: dict):
+        children[sanitized_messages[index]].set_result(parsed)
+    
+    def _fill_missing(batch_future: Future):
+        try:
+            resolved = batch_future.result()
+        except Exception:
+            resolved = set()
+        for index, message in enumerate(sanitized_messages):
+            if index not in resolved:
+                child = children[message]
+                retry = pool.submit(_request_gemini, session, api_key, message)
+                retry.add_done_callback(lambda f, child=child: child.set_result(f.result()))
+    
+    pool.submit(_request_gemini_batch, session, api_key, sanitized_messages, _resolve).add_done_callback(_fill_missing)
+
+def prefetch_gemini(messages: list):
+    """続けて処理するメッセージ（定型コマンド等）のLLM呼び出しを先にまとめて投げておく"""
+    api_key = _get_api_key()
+    if not api_key:
+        return
+    sanitized_messages = [sanitize_message(message)[0] for message in messages]
+    in_flight = st.session_state.setdefault("llm_futures", {})
+    # 中断されたキューの先読み結果が残っていれば捨てる（後で同じ入力が来ても古い結果を使わない）
+    for stale in [m for m in in_flight if m not in sanitized_messages]:
+        del in_flight[stale]
+    pending = []
+    for sanitized_message in sanitized_messages:
+        if (not is_command_cached(get_cache_key(sanitized_message))
+                and sanitized_message not in in_flight
+                and sanitized_message not in pending
+                and route_locally(sanitized_message) is None):
+            # ルールで確実に解釈できるものはLLMに送らないので、先読みも不要
+            pending.append(sanitized_message)
+    
+    # 1件だけなら通常の問い合わせ（まとめる意味がなく、応答も早い）
+    if len(pending) == 1:
+        _submit_gemini(pending[0], api_key)
+        return
+    for i in range(0, len(pending), LLM_BATCH_MAX):
+        _submit_gemini_batch(pending[i:i + LLM_BATCH_MAX], api_key)
+
+def call_gemini(user_message: str) -> tuple:
+    """Google AI Studio APIを呼び出す（ルールで確実に解釈できる入力はローカルで応答、エラー時はモック応答）
     
-    if "メンテナンス" in message_lower:
-        host_match = re.search(r'([A-Za-z][A-Za-z0-9_-]+)', user_message)
-        host_id = host_match.group(1) if host_match else "WAN_ROUTER_01"
-        time_match = re.search(r'(\d+)\s*(分|時間|hour|min)', message_lower)
-        duration = 60
-        if time_match:
-            duration = int(time_match.group(1))
-            if "時間" in time_match.group(2) or "hour" in time_match.group(2):
-                duration *= 60
-        return {"intent": f"{host_id}をメンテナンスモードに設定", "action": "set_maintenance", "parameters": {"host_id": host_id, "duration_minutes": duration}}
+    Returns:
+        (応答dict, キャッシュ種別: 完全一致なら True、類似コマンドなら "semantic"、キャッシュ外なら False)
+    """
     
-    # ★ グラフ表示を先にチェック（CPU検索より前に）
-    if "グラフ" in message_lower or "推移" in message_lower or "トレンド" in message_lower:
-        host_match = re.search(r'([A-Za-z][A-Za-z0-9_-]+)', user_message)
-        host_id = host_match.group(1) if host_match else "WAN_ROUTER_01"
-        # メトリクス判定
-        if "memory" in message_lower or "メモリ" in message_lower:
-            metric = "memory"
-        elif "disk" in message_lower or "ディスク" in message_lower:
-            metric = "disk"
-        else:
-            metric = "cpu"
-        return {"intent": f"{host_id}の{metric}グラフを表示", "action": "show_graph", "parameters": {"host_id": host_id, "metric": metric, "hours": 24}}
+    # ★ サニタイズ処理
+    sanitized_message, detected_secrets = sanitize_message(user_message)
     
-    # CPU/メモリ/ディスク検索（数値閾値がある場合のみ）
-    for metric_ja, metric_en in [("cpu", "cpu"), ("メモリ", "memory"), ("ディスク", "disk")]:
-        if metric_ja in message_lower:
-            # 数値がある場合のみ検索として処理
-            threshold_match = re.search(r'(\d+)\s*%?', user_message)
-            if threshold_match:
-                threshold = int(threshold_match.group(1))
-                operator = ">"
-                if "以下" in message_lower or "未満" in message_lower:
-                    operator = "<"
-                elif "以上" in message_lower:
-                    operator = ">="
-                return {"intent": f"{metric_en}{threshold}%{operator}のホストを検索", "action": "search_hosts", "parameters": {"metric": metric_en, "operator": operator, "value": threshold}}
-    
-    if "メトリクス" in message_lower or "状態" in message_lower or "情報" in message_lower:
-        host_match = re.search(r'([A-Za-z][A-Za-z0-9_-]+)', user_message)
-        if host_match:
-            return {"intent": f"{host_match.group(1)}のメトリクスを取得", "action": "get_metrics", "parameters": {"host_id": host_match.group(1)}}
-    
-    if "アラート" in message_lower or "障害" in message_lower or "問題" in message_lower:
-        return {"intent": "現在のアラート一覧を取得", "action": "get_alerts", "parameters": {}}
+    # 秘密情報が検出された場合、警告をセッションに保存
+    if detected_secrets:
+        st.session_state.sanitize_warning = detected_secrets
     
+    try:
+        return _interpret_message(sanitized_message)
+    finally:
+        # どの経路で答えても、このメッセージの先読み結果はここで使い終わりにする
+        st.session_state.get("llm_futures", {}).pop(sanitized_message, None)
+
+def _interpret_message(sanitized_message: str) -> tuple:
+    """サニタイズ済みの入力を、キャッシュ → ルール → 類似コマンド → LLM の順で解釈する"""
+    # キャッシュのキーもサニタイズ済みの文字列にする（秘密情報をセッションに残さない）
+    # 正規化はこのターンで1回だけ行い、参照・登録・類似検索で使い回す
+    key = get_cache_key(sanitized_message)
+    cached = _get_cached_by_key(key, sanitized_message)
+    if cached is not None:
+        return cached, True
+    
+    # ルールで確実に解釈できる入力はLLMを呼ばずにローカルで応答する
+    # ルールの結果は決定的なのでそのままキャッシュする
+    # キーと同じくNFKC正規化した文字列で判定する（全角の「ＣＰＵ」等で同じキーの入力が別の解釈にならないように）
+    routing_text = unicodedata.normalize("NFKC", sanitized_message)
+    local_response = generate_mock_response(routing_text)  # サニタイズ済みを使用
+    if is_confident_local_response(routing_text, local_response):
+        _set_cache_by_key(key, sanitized_message, local_response)
+        return local_response, False
+    
+    api_key = _get_api_key()
+    if not api_key:
+        # デモモードは広めのルールで応答する。この結果はセッションの履歴にだけ残し、
+        # 共有キャッシュには入れない（APIキー設定後にLLMの解釈を隠さないため）
+        if local_response.get("action") != "unknown":
+            _cache_store(get_command_cache(), key, sanitized_message, local_response)
+        return local_response, False
+    
+    # 言い換え程度の違いなら、LLMを呼ばずに類似コマンドの結果を使う
+    similar = get_similar_cached_command(key)
+    if similar is not None:
+        return similar, "semantic"
+    
+    parsed = _submit_gemini(sanitized_message, api_key).result()
+    if parsed:
+        if parsed.get("action") != "unknown":
+            _set_cache_by_key(key, sanitized_message, parsed)
+            remember_similar_command(key)
+        return parsed, False
+    
+    # API失敗時のフォールバックはキャッシュしない（次回は再びAPIを試す）
+    return local_response, False
+
+def _mock_generate_config(user_message: str, message_lower: str, tags: set, host_id: str):
+    if "CONFIG" in tags:
+        return {"intent": "トポロジーからZabbix設定を生成", "action": "generate_config", "parameters": {}}
+    return None
+
+def _mock_set_maintenance(user_message: str, message_lower: str, tags: set, host_id: str):
+    host_id = host_id or "WAN_ROUTER_01"
+    time_match = _DURATION_RE.search(message_lower)
+    duration = 60
+    if time_match:
+        duration = int(time_match.group(1))
+        if "時間" in time_match.group(2) or "hour" in time_match.group(2):
+            duration *= 60
+    return {"intent": f"{host_id}をメンテナンスモードに設定", "action": "set_maintenance", "parameters": {"host_id": host_id, "duration_minutes": duration}}
+
+def _mock_show_graph(user_message: str, message_lower: str, tags: set, host_id: str):
+    host_id = host_id or "WAN_ROUTER_01"
+    # メトリクス判定
+    if "M_MEM" in tags:
+        metric = "memory"
+    elif "M_DISK" in tags:
+        metric = "disk"
+    else:
+        metric = "cpu"
+    return {"intent": f"{host_id}の{metric}グラフを表示", "action": "show_graph", "parameters": {"host_id": host_id, "metric": metric, "hours": 24}}
+
+def _mock_search_hosts(user_message: str, message_lower: str, tags: set, host_id: str):
+    # 数値がある場合のみ検索として処理
+    threshold_match = _PCT_RE.search(user_message)
+    if not threshold_match:
+        return None
+    metric_en = next(en for tag, en in (("M_CPU", "cpu"), ("M_MEM", "memory"), ("M_DISK", "disk")) if tag in tags)
+    threshold = int(threshold_match.group(1))
+    operator = ">"
+    if "OP_LE" in tags:
+        operator = "<"
+    elif "OP_GE" in tags:
+        operator = ">="
+    return {"intent": f"{metric_en}{threshold}%{operator}のホストを検索", "action": "search_hosts", "parameters": {"metric": metric_en, "operator": operator, "value": threshold}}
+
+def _mock_get_metrics(user_message: str, message_lower: str, tags: set, host_id: str):
+    if host_id:
+        return {"intent": f"{host_id}のメトリクスを取得", "action": "get_metrics", "parameters": {"host_id": host_id}}
+    return None
+
+def _mock_get_alerts(user_message: str, message_lower: str, tags: set, host_id: str):
+    return {"intent": "現在のアラート一覧を取得", "action": "get_alerts", "parameters": {}}
+
+def _mock_show_server_info(user_message: str, message_lower: str, tags: set, host_id: str):
+    return {"intent": "サーバー情報を表示", "action": "show_server_info", "parameters": {}}
+
+# キーワード → 分類タグ（ハンドラは元の文言ではなくタグで分岐する）
+_KEYWORD_TAGS = {
+    "トポロジー": "ACT_TOPOLOGY",
+    "設定": "CONFIG", "監視": "CONFIG",
+    "メンテナンス": "ACT_MAINT",
+    "グラフ": "ACT_GRAPH", "推移": "ACT_GRAPH", "トレンド": "ACT_GRAPH",
+    "メトリクス": "ACT_METRICS", "状態": "ACT_METRICS", "情報": "ACT_METRICS",
+    "アラート": "ACT_ALERT", "障害": "ACT_ALERT", "問題": "ACT_ALERT",
+    "サーバー": "ACT_SERVER",
+    "cpu": "M_CPU",
+    "メモリ": "M_MEM", "memory": "M_MEM",
+    "ディスク": "M_DISK", "disk": "M_DISK",
+    "以下": "OP_LE", "未満": "OP_LE",
+    "以上": "OP_GE",
+}
+
+# (トリガーとなるタグ, ハンドラ) を優先度順に並べたルーティング表
+# ハンドラがNoneを返した場合は次のルートへフォールスルーする
+_KEYWORD_ROUTES = [
+    ({"ACT_TOPOLOGY"}, _mock_generate_config),
+    ({"ACT_MAINT"}, _mock_set_maintenance),
+    # ★ グラフ表示を先にチェック（CPU検索より前に）
+    ({"ACT_GRAPH"}, _mock_show_graph),
+    # CPU/メモリ/ディスク検索（数値閾値がある場合のみ）
+    ({"M_CPU", "M_MEM", "M_DISK"}, _mock_search_hosts),
+    ({"ACT_METRICS"}, _mock_get_metrics),
+    ({"ACT_ALERT"}, _mock_get_alerts),
     # サーバー情報
-    if "サーバー" in message_lower:
-        return {"intent": "サーバー情報を表示", "action": "show_server_info", "parameters": {}}
+    ({"ACT_SERVER"}, _mock_show_server_info),
+]
+
+# 全キーワードを1回の走査で拾うための正規表現（長いキーワードを優先）
+_KEYWORD_RE = re.compile("|".join(map(re.escape, sorted(_KEYWORD_TAGS, key=len, reverse=True))))
+
+def generate_mock_response(user_message: str) -> dict:
+    """パターンマッチングによるモック応答"""
+    message_lower = user_message.lower()
+    tags = {_KEYWORD_TAGS[kw] for kw in _KEYWORD_RE.findall(message_lower)}
+    # ホスト名は複数のハンドラが使うため、ここで1回だけ抽出して渡す（見つからなければ空文字）
+    host_match = _HOST_RE.search(user_message)
+    host_id = host_match.group(1) if host_match else ""
+    
+    for route_tags, handler in _KEYWORD_ROUTES:
+        if tags & route_tags:
+            response = handler(user_message, message_lower, tags, host_id)
+            if response:
+                return response
     
     return {"intent": "不明", "action": "unknown", "parameters": {"original_query": user_message}}
 
-# ==================== メッセージ処理 ====================
+# LLMより先にルールで答えてよいアクション（アラート/サーバー情報は語を含むだけで拾うので含めない）
+_CONFIDENT_LOCAL_ACTIONS = {"generate_config", "set_maintenance", "show_graph", "search_hosts", "get_metrics"}
+# 閾値は「%」の付いた数値だけを信用する（ホスト名末尾の数字を閾値と取り違えない）
+_PCT_ANCHORED_RE = re.compile(r'(\d+)\s*%')
+# 比較の語と、その語が意味する演算子（ルールの演算子と食い違う「以下」等はLLMに任せる）
+_OPERATOR_WORDS = {"以上": ">=", "以下": "<=", "未満": "<", "超え": ">", "超": ">", "より大きい": ">", "より小さい": "<"}
+_OPERATOR_WORD_RE = re.compile("|".join(sorted(_OPERATOR_WORDS, key=len, reverse=True)))
+# メンテナンスの設定ではなく、解除や問い合わせと読める語
+_MAINT_NON_SET_RE = re.compile(r'解除|終了|状態|確認|予定|キャンセル|取り消|止め|いつ')
+_METRIC_TAGS = {"M_CPU", "M_MEM", "M_DISK"}
 
-def process_message(user_message: str) -> dict:
-    """メッセージを処理して応答を生成"""
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _host_id_index(mock_mtime: float, topology_mtime: float) -> frozenset:
+    """モックデータとトポロジーに登場するホストIDの集合（不変なのでコピーせずに共有する）"""
+    topology = _shared_json(TOPOLOGY_PATH, topology_mtime) if topology_mtime else {}
+    return frozenset((*get_hosts(), *topology))
+
+def _known_host_ids() -> frozenset:
+    return _host_id_index(_mock_data_mtime(), _file_mtime(TOPOLOGY_PATH) or 0.0)
+
+def is_confident_local_response(user_message: str, response: dict) -> bool:
+    """generate_mock_response の結果が、LLMより先に使ってよいほど確かなものか
     
-    cached = get_cached_command(user_message)
-    if cached:
-        response = cached
-        is_cached = True
+    generate_mock_response はデモモード/API失敗時のフォールバックなので広く拾うが、
+    APIキーがある場合に先回りしてよいのは確度の高いルートだけにする
+    """
+    action = response["action"]
+    if action not in _CONFIDENT_LOCAL_ACTIONS:
+        return False
+    params = response["parameters"]
+    known_hosts = _known_host_ids()
+    message_lower = user_message.lower()
+    metric_tags = {_KEYWORD_TAGS[kw] for kw in _KEYWORD_RE.findall(message_lower)} & _METRIC_TAGS
+    if action == "search_hosts":
+        # 実在するホスト名を除いた残りに%付きの数値がちょうど1つあり、閾値と一致する場合だけ
+        # （「20%から80%の間」のような範囲指定はルールでは表せない）
+        text = user_message
+        for host_id in _HOST_RE.findall(user_message):
+            if host_id in known_hosts:
+                text = text.replace(host_id, " ")
+        pct_values = _PCT_ANCHORED_RE.findall(text)
+        if len(pct_values) != 1 or int(pct_values[0]) != params["value"] or len(metric_tags) != 1:
+            return False
+        # 比較の語があれば、それが1通りに決まり、ルールの演算子と一致すること
+        operators = {_OPERATOR_WORDS[word] for word in _OPERATOR_WORD_RE.findall(text)}
+        return not operators or operators == {params["operator"]}
+    if action == "set_maintenance":
+        # 期間を明示した設定の依頼だけ（「解除して」「状態は？」を設定と取り違えない）
+        if not _DURATION_RE.search(message_lower) or _MAINT_NON_SET_RE.search(user_message):
+            return False
+    elif action == "show_graph":
+        # 対応するメトリクス名が1つだけある場合（帯域などをCPUのグラフにすり替えない）
+        if len(metric_tags) != 1:
+            return False
+    # 既定ホストで補った場合や、英単語をホスト名と取り違えた場合は任せない
+    host_id = params.get("host_id")
+    return host_id is None or (host_id in known_hosts and host_id in user_message)
+
+def route_locally(user_message: str):
+    """ルールだけで取り違えなく解釈できる入力なら応答を返す（曖昧ならNoneを返してLLMに任せる）"""
+    routing_text = unicodedata.normalize("NFKC", user_message)
+    response = generate_mock_response(routing_text)
+    return response if is_confident_local_response(routing_text, response) else None
+
+# ==================== メッセージ処理 ====================
+
+# アクションごとのハンドラ（解釈済みのパラメータを受け取り、表示用の結果をresultに書き込む）
+
+def _handle_generate_config(params: dict, result: dict, data: dict, user_message: str):
+    """トポロジーからZabbix設定を生成する"""
+    config = get_generated_config()
+    if not config or not config["hosts"]:
+        result["message"] = "❌ トポロジーデータがありません。サイドバーからアップロードしてください。"
     else:
-        response = call_gemini(user_message)
-        is_cached = False
-        if response.get("action") != "unknown":
-            set_command_cache(user_message, response)
-    
-    action = response.get("action", "unknown")
-    params = response.get("parameters", {})
-    
-    result = {"response": response, "cached": is_cached}
-    
-    if action == "generate_config":
-        topology = load_topology()
-        if not topology:
-            result["message"] = "❌ トポロジーデータがありません。サイドバーからアップロードしてください。"
-        else:
-            config = generate_zabbix_config(topology)
-            result["config"] = config
-            result["message"] = f"""✅ Zabbix設定を生成しました：
+        result["config"] = config
+        result["message"] = f"""✅ Zabbix設定を生成しました：
 • ホスト: {len(config['hosts'])}台
 • ホストグループ: {len(config['host_groups'])}個
 • トリガー: {len(config['triggers'])}個
 • 依存関係: {len(config['dependencies'])}件"""
-            
-    elif action == "set_maintenance":
-        host_id = params.get("host_id", "不明")
-        duration = params.get("duration_minutes", 60)
-        start_time = datetime.now()
-        end_time = start_time + timedelta(minutes=duration)
-        
-        if "maintenance" not in st.session_state:
-            st.session_state.maintenance = {}
-        st.session_state.maintenance[host_id] = {
-            "start": start_time.isoformat(),
-            "end": end_time.isoformat(),
-            "duration": duration
-        }
-        
-        result["message"] = f"""✅ {host_id}をメンテナンスモードに設定しました
-• 開始: {start_time.strftime('%Y-%m-%d %H:%M')}
-• 終了: {end_time.strftime('%Y-%m-%d %H:%M')}
-• 期間: {duration}分"""
-        result["maintenance"] = st.session_state.maintenance[host_id]
-        
-    elif action == "search_hosts":
-        metric = params.get("metric", "cpu")
-        operator = params.get("operator", ">")
-        value = params.get("value", 80)
-        
-        hosts = get_hosts_by_condition(metric, operator, value)
-        result["hosts"] = hosts
-        
-        if hosts:
-            host_list = "\n".join([f"• {h['host_id']}: {h['current_value']:.1f}%" for h in hosts])
-            result["message"] = f"🔍 {len(hosts)}台見つかりました：\n{host_list}"
-        else:
-            result["message"] = f"✅ 条件に合うホストはありません（{metric} {operator} {value}%）"
-            
-    elif action == "get_metrics":
-        host_id = params.get("host_id")
-        metrics = get_host_metrics(host_id)
-        
-        if metrics:
-            result["metrics"] = metrics
-            metrics_lines = []
-            for k, v in metrics.items():
-                if isinstance(v, float):
-                    metrics_lines.append(f"• {k}: {v:.1f}%")
-                else:
-                    metrics_lines.append(f"• {k}: {v}")
-            result["message"] = f"📊 {host_id}のメトリクス：\n" + "\n".join(metrics_lines)
-        else:
-            result["message"] = f"❌ ホスト {host_id} が見つかりません"
-            
-    elif action == "get_alerts":
-        alerts = get_alerts()
-        result["alerts"] = alerts
-        
-        if alerts:
-            alert_list = "\n".join([
-                f"{'🔴' if a['severity']=='high' else '🟡'} {a['host']}: {a['message']}" 
-                for a in alerts
-            ])
-            result["message"] = f"⚠️ {len(alerts)}件のアラート：\n{alert_list}"
-        else:
-            result["message"] = "✅ 現在アラートはありません"
-            
-    elif action == "show_graph":
-        host_id = params.get("host_id", "WAN_ROUTER_01")
-        metric = params.get("metric", "cpu")
-        hours = params.get("hours", 24)
-        
-        history = generate_metrics_history(host_id, metric, hours)
-        result["graph_data"] = history
-        result["host_id"] = host_id
-        result["metric"] = metric
-        
-        if history:
-            peak = max(history, key=lambda x: x["value"])
-            result["message"] = f"📈 {host_id}の{metric}推移（過去{hours}時間）\nピーク: {peak['value']:.1f}% ({peak['timestamp'].strftime('%H:%M')})"
-        else:
-            result["message"] = f"❌ {host_id}の{metric}データがありません"
+
+def _handle_set_maintenance(params: dict, result: dict, data: dict, user_message: str):
+    """ホストをメンテナンスモードに設定する"""
+    host_id = params.get("host_id", "不明")
+    duration = params.get("duration_minutes", 60)
+    # 期間の計算はエポック秒で行い、表示用の文字列はメッセージ生成時にだけ作る
+    start = time.time()
+    end = start + duration * 60
+    
+    if "maintenance" not in st.session_state:
+        st.session_state.maintenance = {}
+    st.session_state.maintenance[host_id] = {
+        "start": start,
+        "end": end,
+        "duration": duration
+    }
     
-    elif action == "show_server_info":
-        result["message"] = "📊 サーバー情報ダイアログを開きます"
-        result["show_server_dialog"] = True
+    result["message"] = f"""✅ {host_id}をメンテナンスモードに設定しました
+• 開始: {datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M')}
+• 終了: {datetime.fromtimestamp(end).strftime('%Y-%m-%d %H:%M')}
+• 期間: {duration}分"""
+    result["maintenance"] = st.session_state.maintenance[host_id]
+
+def _handle_search_hosts(params: dict, result: dict, data: dict, user_message: str):
+    """メトリクスの条件に合うホストを検索する"""
+    hosts = _get_hosts(data)
+    metric = params.get("metric", "cpu")
+    operator = params.get("operator", ">")
+    value = params.get("value", 80)
+    
+    matched = _get_hosts_by_condition(hosts, metric, operator, value)
+    result["hosts"] = matched
+    # 重要度アイコンは値の配列からまとめて判定し、表示用の表も応答生成時に1回だけ作る
+    values = np.fromiter((h["current_value"] for h in matched), dtype=np.float64, count=len(matched))
+    result["hosts_df"] = pd.DataFrame({
+        "状態": np.select([values > 90, values > 80], ["🔴", "🟡"], "🟢"),
+        "ホスト": [h["host_id"] for h in matched],
+        "値": values,
+    })
+    
+    if matched:
+        host_list = "\n".join(f"• {h['host_id']}: {v:.1f}%" for h, v in zip(matched, values))
+        result["message"] = f"🔍 {len(matched)}台見つかりました：\n{host_list}"
+    else:
+        result["message"] = f"✅ 条件に合うホストはありません（{metric} {operator} {value}%）"
+
+def _handle_get_metrics(params: dict, result: dict, data: dict, user_message: str):
+    """ホストの現在のメトリクスを返す"""
+    hosts = _get_hosts(data)
+    host_id = params.get("host_id")
+    metrics = _get_host_metrics(hosts, host_id)
+    
+    if metrics:
+        result["metrics"] = metrics
+        metrics_lines = "\n".join(
+            f"• {k}: {v:.1f}%" if isinstance(v, float) else f"• {k}: {v}" for k, v in metrics.items()
+        )
+        result["message"] = f"📊 {host_id}のメトリクス：\n{metrics_lines}"
+    else:
+        result["message"] = f"❌ ホスト {host_id} が見つかりません"
+
+def _handle_get_alerts(params: dict, result: dict, data: dict, user_message: str):
+    """現在のアラート一覧を返す"""
+    alerts = _get_alerts(data)
+    result["alerts"] = alerts
+    
+    if alerts:
+        alert_list = "\n".join(
+            f"{_SEVERITY_ICONS.get(a['severity'], '🟡')} {a['host']}: {a['message']}" for a in alerts
+        )
+        result["message"] = f"⚠️ {len(alerts)}件のアラート：\n{alert_list}"
     else:
-        result["message"] = f"""🤔 「{user_message}」の意図を理解できませんでした。
+        result["message"] = "✅ 現在アラートはありません"
+
+def _handle_show_graph(params: dict, result: dict, data: dict, user_message: str):
+    """メトリクスの推移グラフ用データを作る"""
+    host_id = params.get("host_id", "WAN_ROUTER_01")
+    metric = params.get("metric", "cpu")
+    hours = params.get("hours", 24)
+    
+    history = generate_metrics_history(host_id, metric, hours)
+    # 再描画のたびに変換しないよう、グラフ用のSeriesは生成時に1回だけ作る
+    result["graph_df"] = history.set_index("timestamp")["value"]
+    result["host_id"] = host_id
+    result["metric"] = metric
+    
+    if not history.empty:
+        # 行(Series)を組み立てず、列の配列上でargmaxを取って該当要素だけ読む
+        values = history["value"].to_numpy()
+        peak = int(values.argmax())
+        peak_time = history["timestamp"].iat[peak]
+        result["message"] = f"📈 {host_id}の{metric}推移（過去{hours}時間）\nピーク: {values[peak]:.1f}% ({peak_time.strftime('%H:%M')})"
+    else:
+        result["message"] = f"❌ {host_id}の{metric}データがありません"
+
+def _handle_show_server_info(params: dict, result: dict, data: dict, user_message: str):
+    """サーバー情報ダイアログを開く"""
+    result["message"] = "📊 サーバー情報ダイアログを開きます"
+    result["show_server_dialog"] = True
+
+def _handle_unknown(params: dict, result: dict, data: dict, user_message: str):
+    """解釈できなかった入力に例文を返す"""
+    result["message"] = f"""🤔 「{user_message}」の意図を理解できませんでした。
 
 以下のような質問をお試しください：
 • トポロジーで監視設定して
@@ -959,11 +1679,106 @@ def process_message(user_message: str) -> dict:
 • WAN_ROUTER_01のメトリクス見せて
 • 現在のアラート教えて
 • CORE_SW_01のCPU推移をグラフで"""
+
+# アクション名 -> ハンドラ（未知のアクションは _handle_unknown）
+_HANDLERS = {
+    "generate_config": _handle_generate_config,
+    "set_maintenance": _handle_set_maintenance,
+    "search_hosts": _handle_search_hosts,
+    "get_metrics": _handle_get_metrics,
+    "get_alerts": _handle_get_alerts,
+    "show_graph": _handle_show_graph,
+    "show_server_info": _handle_show_server_info,
+}
+
+def process_message(user_message: str) -> dict:
+    """メッセージを処理して応答を生成"""
+    
+    response, is_cached = call_gemini(user_message)
+    
+    action = response.get("action", "unknown")
+    params = response.get("parameters", {})
+    # ヘルパーごとにキャッシュを引き直さないよう、モックデータはここで1回だけ取得する
+    data = load_mock_data()
     
+    result = {"response": response, "cached": is_cached}
+    _HANDLERS.get(action, _handle_unknown)(params, result, data, user_message)
     return result
 
 # ==================== UI ====================
 
+# チャット履歴で一度に描画するメッセージ数
+HISTORY_WINDOW = 20
+
+def _render_graph(result: dict):
+    """応答に含まれるメトリクス推移をグラフ表示する（Seriesは応答生成時に作成済み）"""
+    graph_df = result.get("graph_df")
+    if graph_df is not None and not graph_df.empty:
+        st.line_chart(graph_df, use_container_width=True)
+
+def _render_hosts(result: dict):
+    """検索に一致したホストを1つの表として表示する（行ごとに要素を作らない）"""
+    hosts_df = result.get("hosts_df")
+    if hosts_df is not None and not hosts_df.empty:
+        st.dataframe(
+            hosts_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={"値": st.column_config.NumberColumn(format="%.1f%%")}
+        )
+
+def _drain_sanitize(label: str):
+    """サニタイズ警告があれば1回だけ表示して消す"""
+    warnings = st.session_state.pop("sanitize_warning", None)
+    if warnings:
+        st.warning(f"{label}: {', '.join(warnings)}")
+
+def _render_result_data(result: dict, key: str):
+    """応答に付随するグラフ・設定・ホスト一覧を表示する（key はメッセージごとに一意なウィジェットキー）"""
+    _render_graph(result)
+    
+    if "config" in result:
+        with st.expander("📋 生成された設定を表示", expanded=True):
+            display_config_summary(result["config"], key=key)
+    
+    _render_hosts(result)
+
+def _render_assistant_result(result: dict, key: str):
+    """処理したばかりの応答を表示する（履歴の再描画では _render_result_data だけを使う）"""
+    # サニタイズ警告があれば表示
+    _drain_sanitize("🔒 秘密情報を検出・削除しました")
+    
+    if result.get("cached") == "semantic":
+        st.caption("⚡ 類似の過去コマンドから応答（近似）")
+    elif result.get("cached"):
+        st.caption("⚡ キャッシュから応答")
+    
+    st.markdown(result.get("message", ""))
+    _render_result_data(result, key)
+    
+    if result.get("show_server_dialog"):
+        st.session_state.show_server_dialog = True
+
+def _submit_user_message(user_message: str) -> dict:
+    """ユーザーメッセージを処理して応答を表示し、両方を会話履歴に追加する"""
+    st.session_state.messages.append({"role": "user", "content": user_message})
+    
+    with st.chat_message("user"):
+        st.markdown(user_message)
+    
+    with st.chat_message("assistant"):
+        with st.spinner("処理中..."):
+            result = process_message(user_message)
+        # 応答は次の位置に追加されるので、履歴側と同じウィジェットキーになる
+        _render_assistant_result(result, key=str(len(st.session_state.messages)))
+    
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": result.get("message", ""),
+        "data": result
+    })
+    return result
+
 def main():
     # ヘッダー
     col1, col2 = st.columns([3, 1])
@@ -999,12 +1814,11 @@ def main():
         
         if uploaded_file:
             try:
-                new_topology = json.load(uploaded_file)
+                new_topology = orjson.loads(uploaded_file.getvalue())
                 os.makedirs(DATA_DIR, exist_ok=True)
-                with open(os.path.join(DATA_DIR, "topology.json"), "w", encoding="utf-8") as f:
-                    json.dump(new_topology, f, ensure_ascii=False, indent=2)
+                with open(TOPOLOGY_PATH, "wb") as f:
+                    f.write(orjson.dumps(new_topology, option=orjson.OPT_INDENT_2))
                 st.success(f"✅ {len(new_topology)}台のデバイスを読み込みました")
-                st.cache_data.clear()
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ 読み込みエラー: {e}")
@@ -1116,6 +1930,7 @@ def main():
                         if st.button(f"{cmd['name']}", key=f"custom_run_{i}", use_container_width=True, help=cmd.get("description", "")):
                             # 複数コマンドを順番に実行するためキューに追加
                             st.session_state.command_queue = cmd["commands"].copy()
+                            prefetch_gemini(cmd["commands"])
                             st.session_state.pending_message = st.session_state.command_queue.pop(0)
                             st.rerun()
                     with col2:
@@ -1175,7 +1990,8 @@ def main():
             cache = get_command_cache()
             
             if cache:
-                st.caption(f"{len(cache)}件のコマンドを記録中")
+                stats = get_command_cache_stats()
+                st.caption(f"{len(cache)}件のコマンドを記録中（ヒット {stats['hits']} / ミス {stats['misses']}）")
                 
                 # 使用回数でソート
                 sorted_cache = sorted(
@@ -1221,7 +2037,12 @@ def main():
                                 st.toast("既にお気に入りに登録済みです")
                 
                 if st.button("🗑️ 履歴クリア", key="clear_cache", use_container_width=True):
-                    st.session_state.command_cache = {}
+                    # このセッションの履歴と、その解釈結果を共有キャッシュから消す
+                    # （他のセッションだけが登録した解釈結果は残す）
+                    forget_shared_commands(cache)
+                    st.session_state.command_cache = OrderedDict()
+                    st.session_state.pop("command_cache_stats", None)
+                    st.session_state.pop("similar_index", None)
                     st.success("履歴をクリアしました")
                     st.rerun()
             else:
@@ -1230,9 +2051,29 @@ def main():
         
         st.divider()
         
+        # 送信済みメッセージの編集・コピー（メッセージごとにボタンを並べず、選択式の1組だけにする）
+        messages = st.session_state.get("messages", [])
+        user_indices = [i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"]
+        if user_indices:
+            selected_idx = st.selectbox(
+                "✏️ 送信済みメッセージ",
+                user_indices,
+                format_func=lambda i: messages[i]["content"][:40],
+                key="selected_user_message"
+            )
+            msg_col1, msg_col2 = st.columns(2)
+            with msg_col1:
+                if st.button("📋 コピー", key="copy_selected_message", use_container_width=True):
+                    st.session_state.clipboard = messages[selected_idx]["content"]
+                    st.toast("コピーしました")
+            with msg_col2:
+                if st.button("✏️ 編集", key="edit_selected_message", use_container_width=True, help="編集して再送信"):
+                    st.session_state.edit_message = messages[selected_idx]["content"]
+        
         # チャット履歴クリア
         if st.button("🗑️ チャット履歴クリア", use_container_width=True):
             st.session_state.messages = []
+            st.session_state.pop("history_visible", None)
             st.rerun()
     
     # === ダイアログ表示 ===
@@ -1291,97 +2132,33 @@ def main():
             }
         ]
     
-    # チャット履歴の表示
-    for idx, message in enumerate(st.session_state.messages):
+    # チャット履歴の表示（直近のみ描画し、古いものはボタンで段階的に読み込む）
+    messages = st.session_state.messages
+    visible = st.session_state.get("history_visible", HISTORY_WINDOW)
+    start = max(len(messages) - visible, 0)
+    if start > 0:
+        if st.button(f"⬆️ 過去のメッセージを表示（残り{start}件）", key="show_older_messages"):
+            st.session_state.history_visible = visible + HISTORY_WINDOW
+            st.rerun()
+    
+    for idx in range(start, len(messages)):
+        message = messages[idx]
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
             
-            # ユーザーメッセージの場合、編集・コピーボタン
-            if message["role"] == "user":
-                btn_col1, btn_col2, btn_col3 = st.columns([1, 1, 4])
-                with btn_col1:
-                    if st.button("📋", key=f"copy_{idx}", help="コピー"):
-                        st.session_state.clipboard = message["content"]
-                        st.toast("コピーしました")
-                with btn_col2:
-                    if st.button("✏️", key=f"edit_{idx}", help="編集して再送信"):
-                        st.session_state.edit_message = message["content"]
-            
             # 追加データの表示
             if "data" in message:
-                data = message["data"]
-                
-                if "graph_data" in data and data["graph_data"]:
-                    import pandas as pd
-                    df = pd.DataFrame(data["graph_data"])
-                    df["timestamp"] = pd.to_datetime(df["timestamp"])
-                    df = df.set_index("timestamp")
-                    st.line_chart(df["value"], use_container_width=True)
-                
-                if "config" in data:
-                    with st.expander("📋 生成された設定を表示", expanded=True):
-                        display_config_summary(data["config"])
-                
-                if "hosts" in data and data["hosts"]:
-                    for host in data["hosts"]:
-                        severity_color = "🔴" if host["current_value"] > 90 else "🟡" if host["current_value"] > 80 else "🟢"
-                        st.markdown(f"{severity_color} **{host['host_id']}**: {host['current_value']:.1f}%")
+                _render_result_data(message["data"], key=str(idx))
     
     # サニタイズ警告の表示
-    if "sanitize_warning" in st.session_state and st.session_state.sanitize_warning:
-        warnings = st.session_state.sanitize_warning
-        st.warning(f"⚠️ 秘密情報を検出したため、LLMへの送信前に削除しました: {', '.join(warnings)}")
-        del st.session_state.sanitize_warning
+    _drain_sanitize("⚠️ 秘密情報を検出したため、LLMへの送信前に削除しました")
     
     # クイックアクションからのメッセージ処理
     if "pending_message" in st.session_state:
         pending = st.session_state.pending_message
         del st.session_state.pending_message
         
-        st.session_state.messages.append({"role": "user", "content": pending})
-        
-        with st.chat_message("user"):
-            st.markdown(pending)
-        
-        with st.chat_message("assistant"):
-            with st.spinner("処理中..."):
-                result = process_message(pending)
-            
-            # サニタイズ警告があれば表示
-            if "sanitize_warning" in st.session_state and st.session_state.sanitize_warning:
-                warnings = st.session_state.sanitize_warning
-                st.warning(f"🔒 秘密情報を検出・削除しました: {', '.join(warnings)}")
-                del st.session_state.sanitize_warning
-            
-            if result.get("cached"):
-                st.caption("⚡ キャッシュから応答")
-            
-            st.markdown(result.get("message", ""))
-            
-            if "graph_data" in result and result["graph_data"]:
-                import pandas as pd
-                df = pd.DataFrame(result["graph_data"])
-                df["timestamp"] = pd.to_datetime(df["timestamp"])
-                df = df.set_index("timestamp")
-                st.line_chart(df["value"], use_container_width=True)
-            
-            if "config" in result:
-                with st.expander("📋 生成された設定を表示", expanded=True):
-                    display_config_summary(result["config"])
-            
-            if "hosts" in result and result["hosts"]:
-                for host in result["hosts"]:
-                    severity_color = "🔴" if host["current_value"] > 90 else "🟡" if host["current_value"] > 80 else "🟢"
-                    st.markdown(f"{severity_color} **{host['host_id']}**: {host['current_value']:.1f}%")
-            
-            if result.get("show_server_dialog"):
-                st.session_state.show_server_dialog = True
-        
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": result.get("message", ""),
-            "data": result
-        })
+        _submit_user_message(pending)
         
         # 定型コマンドの連続実行（キューに残りがあれば次を実行）
         if "command_queue" in st.session_state and st.session_state.command_queue:
@@ -1405,50 +2182,7 @@ def main():
     else:
         # チャット入力
         if prompt := st.chat_input("メッセージを入力... (例: CPU高いサーバー教えて)"):
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            
-            with st.chat_message("user"):
-                st.markdown(prompt)
-            
-            with st.chat_message("assistant"):
-                with st.spinner("処理中..."):
-                    result = process_message(prompt)
-                
-                # サニタイズ警告があれば表示
-                if "sanitize_warning" in st.session_state and st.session_state.sanitize_warning:
-                    warnings = st.session_state.sanitize_warning
-                    st.warning(f"🔒 秘密情報を検出・削除しました: {', '.join(warnings)}")
-                    del st.session_state.sanitize_warning
-                
-                if result.get("cached"):
-                    st.caption("⚡ キャッシュから応答")
-                
-                st.markdown(result.get("message", ""))
-                
-                if "graph_data" in result and result["graph_data"]:
-                    import pandas as pd
-                    df = pd.DataFrame(result["graph_data"])
-                    df["timestamp"] = pd.to_datetime(df["timestamp"])
-                    df = df.set_index("timestamp")
-                    st.line_chart(df["value"], use_container_width=True)
-                
-                if "config" in result:
-                    with st.expander("📋 生成された設定を表示", expanded=True):
-                        display_config_summary(result["config"])
-                
-                if "hosts" in result and result["hosts"]:
-                    for host in result["hosts"]:
-                        severity_color = "🔴" if host["current_value"] > 90 else "🟡" if host["current_value"] > 80 else "🟢"
-                        st.markdown(f"{severity_color} **{host['host_id']}**: {host['current_value']:.1f}%")
-                
-                if result.get("show_server_dialog"):
-                    st.session_state.show_server_dialog = True
-            
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": result.get("message", ""),
-                "data": result
-            })
+            _submit_user_message(prompt)
 
 if __name__ == "__main__":
     main()